@@ -9,7 +9,20 @@ Intel RealSense L515 ― depth＋IR 動画保存スクリプト（拡張版）
 
 import os, sys, time, h5py, numpy as np, cv2 as cv, pyrealsense2 as rs
 import platform
+import queue
+import threading
 from datetime import datetime
+from multiprocessing import Event, Process, shared_memory
+
+try:
+    from numba import njit, prange   # 任意依存。無ければ numpy/OpenCV 経路で動く
+except ImportError:
+    njit = None
+
+try:
+    import hdf5plugin   # 任意依存。あれば depth を Blosc2(zstd) で圧縮
+except ImportError:
+    hdf5plugin = None
 
 # -------- ユーザ設定 --------
 ROOT_PATH          = r"D:/Dev/Data"
@@ -17,7 +30,11 @@ W, H               = 1024, 768        # 1024 × 768
 FPS                = 30               # LiDAR/IR は固定
 SAVE_INTERVAL      = 6                # depthを約5fps化
 FILE_PERIOD_MIN    = 1                # 1分で新ファイル
-VISUALIZE          = True             # GUIプレビュー
+CHUNK_ROWS         = 2                # HDF5チャンク行数（2×1024×768×2B ≈ 3MB）
+QUEUE_SIZE         = 4                # 書き込みワーカへのキュー段数
+RS_QUEUE_SIZE      = 1                # librealsense内部キュー（最新フレーム優先）
+VISUALIZE          = True             # GUIプレビュー（別プロセスで表示）
+PREVIEW_FPS        = 10               # プレビュープロセスの更新レート
 PCT_CLIP           = 99               # depth→8bitクリップ率
 INFO_FILENAME      = "000_RUN_INFO.txt"  # フォルダ先頭に来るよう命名
 # ----------------------------
@@ -25,15 +42,90 @@ INFO_FILENAME      = "000_RUN_INFO.txt"  # フォルダ先頭に来るよう命
 RsErr = rs.error if hasattr(rs, "error") else Exception
 def mkdir(p): os.makedirs(p, exist_ok=True)
 
+# 属性は複合型でまとめて書き、ファイルオープンごとの H5Awrite 回数を 8+ → 2 に抑える
+META_DT = np.dtype([
+    ("depth_scale", "f8"), ("width", "i4"), ("height", "i4"),
+    ("fps", "i4"), ("interval", "i4"), ("pct_clip", "i4"),
+    ("start_ts_sys", "f8"),
+])
+META_STR_DT = np.dtype([
+    ("serial", h5py.string_dtype()), ("baby_id", h5py.string_dtype()),
+    ("pc_id", h5py.string_dtype()), ("script", h5py.string_dtype()),
+])
+
+if njit is not None:
+    @njit(cache=True)
+    def _depth_vmax(d16_flat):
+        """ヒストグラム＋累積で有効画素の P{PCT_CLIP} を返す（njit 版）。"""
+        hist = np.zeros(65536, dtype=np.int64)
+        for v in d16_flat:
+            hist[v] += 1
+        valid = d16_flat.size - hist[0]     # 値0（無効画素）を除いた数
+        if valid <= 0:
+            return 1
+        thresh = valid * PCT_CLIP // 100
+        acc = 0
+        for v in range(1, 65536):
+            acc += hist[v]
+            if acc >= thresh:
+                return v
+        return 65535
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _depth_scale8(d16_flat, out8_flat, vmax):
+        """clip+scale+cast を1パスで融合（d16 を一度しか読まない）。"""
+        scale = np.float32(255.0 / max(vmax, 1))
+        for i in prange(d16_flat.size):
+            v = d16_flat[i] * scale
+            out8_flat[i] = np.uint8(255 if v > 255.0 else v)
+
+def depth_compression():
+    """depth データセット用の圧縮設定（create_dataset のキーワード）を返す。
+
+    hdf5plugin があれば Blosc2(zstd, bitshuffle)。uint16 のビット面を
+    並べ替えてから zstd にかけると LZF 比でさらに縮み、かつ十分速い。
+    無ければ h5py 標準の shuffle+LZF に落とす。
+    """
+    if hdf5plugin is not None:
+        return dict(hdf5plugin.Blosc2(cname="zstd", clevel=3,
+                                      filters=hdf5plugin.Blosc2.BITSHUFFLE))
+    return {"compression": "lzf", "shuffle": True}
+
 def depth_to_8bit(d16):
-    valid = d16[d16 > 0]
-    vmax  = np.percentile(valid, PCT_CLIP) if valid.size else 1
-    d8 = np.clip(d16.astype(np.float32), 0, vmax) / vmax * 255
-    return d8.astype(np.uint8)
+    """有効画素の P{PCT_CLIP} を上限に線形スケールして8bit化する。
+
+    depth は [0, 65535] の整数なので、ヒストグラム＋累積和の1パスで
+    百分位値が求まる（選択アルゴリズムも有効画素のコピーも不要）。
+    numba があれば clip/scale/cast を並列1パスのカーネルに融合し、
+    無ければ cv.convertScaleAbs の1パス(SIMD)で処理する（255超は自動飽和）。
+    """
+    if njit is not None:
+        flat = d16.ravel()
+        out8 = depth_to_8bit.out8
+        if out8 is None or out8.size != flat.size:
+            out8 = depth_to_8bit.out8 = np.empty(flat.size, dtype=np.uint8)
+        _depth_scale8(flat, out8, _depth_vmax(flat))
+        return out8.reshape(d16.shape)
+
+    hist  = np.bincount(d16.ravel(), minlength=65536)
+    cum   = np.cumsum(hist)
+    valid = int(cum[-1] - hist[0])      # 値0（無効画素）を除いた数
+    if valid:
+        thresh = valid * PCT_CLIP // 100
+        # cum - hist[0] は「値 v 以下の有効画素数」。thresh に達する最小の v が P{PCT_CLIP}
+        vmax = int(np.searchsorted(cum - hist[0], thresh))
+    else:
+        vmax = 1
+    return cv.convertScaleAbs(d16, alpha=255.0 / max(vmax, 1))
+depth_to_8bit.out8 = None   # 出力バッファは使い回す（毎フレームの確保を避ける）
 
 def init_pipe():
     ctx = rs.context()
     if not ctx.devices: raise RuntimeError("L515 が接続されていません。")
+    # センサ内部キューを絞り、古いフレームを抱え込まず常に最新を受け取る
+    for s in ctx.devices[0].query_sensors():
+        if s.supports(rs.option.frames_queue_size):
+            s.set_option(rs.option.frames_queue_size, RS_QUEUE_SIZE)
     pipe, cfg = rs.pipeline(), rs.config()
     cfg.enable_stream(rs.stream.depth,    W, H, rs.format.z16, FPS)
     cfg.enable_stream(rs.stream.infrared, W, H, rs.format.y8,  FPS)
@@ -45,22 +137,101 @@ def init_pipe():
 
 def open_h5(path, dscale, serial, baby_id, pc_id, script_name):
     cols = W * H
-    f = h5py.File(path, "w")
-    f.attrs.update({
-        "depth_scale": dscale, "width": W, "height": H,
-        "fps": FPS, "interval": SAVE_INTERVAL,
-        "start_ts_sys": time.time(), "serial": serial,
-        "baby_id": str(baby_id), "pc_id": str(pc_id), "script": str(script_name),
-        "pct_clip": PCT_CLIP
-    })
-    d_depth = f.create_dataset("depth", (0, cols), maxshape=(None, cols),
-                               dtype="uint16", chunks=(1, cols))
-    d_ts    = f.create_dataset("ts", (0,), maxshape=(None,), dtype="float64")
+    # ページ割り当て＋大きめのチャンクキャッシュで、細かいメタデータ書き込みを
+    # 1MBページ単位にまとめてからディスクへ流す（NTFSの小書き込みが特に遅いため）
+    f = h5py.File(path, "w", libver="latest",
+                  rdcc_nbytes=32 * 1024 * 1024, rdcc_nslots=10007,
+                  fs_strategy="page", fs_page_size=1024 * 1024)
+    f.attrs["meta"] = np.array(
+        (dscale, W, H, FPS, SAVE_INTERVAL, PCT_CLIP, time.time()), dtype=META_DT)
+    f.attrs["meta_str"] = np.array(
+        (serial, str(baby_id), str(pc_id), str(script_name)), dtype=META_STR_DT)
+    # ブロック長ぶんを先に確保し、ループ中の resize（B-tree更新）をなくす
+    max_rows = FILE_PERIOD_MIN * 60 * FPS // SAVE_INTERVAL + 8
+    # Blosc2(zstd)（hdf5plugin があれば）または shuffle+LZF で圧縮（depth は 2〜3 倍以上縮む）
+    d_depth = f.create_dataset("depth", (max_rows, cols), maxshape=(None, cols),
+                               dtype="uint16", chunks=(CHUNK_ROWS, cols),
+                               **depth_compression())
+    d_ts    = f.create_dataset("ts", (max_rows,), maxshape=(None,), dtype="float64")
     return f, d_depth, d_ts
 
+def flush_depth(ds_depth, ds_ts, buf, tsbuf, n, row):
+    """バッファ済み depth フレームを row 以降へまとめて書き、次の行番号を返す。"""
+    if n == 0:
+        return row
+    if row + n > ds_depth.shape[0]:  # 予約分を超えた時だけ伸長（通常は起きない）
+        ds_depth.resize(row + n, 0)
+        ds_ts.resize(row + n, 0)
+    if (n == CHUNK_ROWS and row % CHUNK_ROWS == 0
+            and ds_depth.id.get_create_plist().get_nfilters() == 0):
+        # フィルタ無しかつチャンク丸ごとなら h5py の選択機構を介さず直接書き込む
+        # （.compression は外部プラグインのフィルタを認識しないため plist で判定）
+        ds_depth.id.write_direct_chunk((row, 0), buf.tobytes())
+    else:
+        ds_depth[row:row + n] = buf[:n]
+    ds_ts[row:row + n] = tsbuf[:n]
+    return row + n
+
+def finalize_h5(path, end_attrs, depth_rows=None):
+    """ブロッククローズ後に開き直し、末尾トリムと終了属性をまとめて書く。"""
+    with h5py.File(path, "a") as f:
+        if depth_rows is not None:
+            f["depth"].resize(depth_rows, 0)
+            f["ts"].resize(depth_rows, 0)
+        f.attrs.update(end_attrs)
+
+# ---- 書き込みワーカ（キャプチャスレッドをI/Oで止めないため分離） ----
+
+# ワーカ例外の通知。ディスクフル等でワーカが死ぬとキューが満杯のまま残り、
+# 終了処理の put(None)/join が永久に固まるため、キャプチャループが監視する
+worker_failed = threading.Event()
+
+def ir_worker(q, writer):
+    """IRフレームをそのまま（1ch GRAY）MP4へ書き込むワーカ。Noneで終了。"""
+    try:
+        while True:
+            ir_gray = q.get()
+            if ir_gray is None:
+                break
+            writer.write(ir_gray)
+    except Exception as e:
+        print(f"ir_worker 異常終了: {e}", file=sys.stderr)
+        worker_failed.set()
+
+def depth_worker(q, ds_depth, ds_ts):
+    """depthフレームをチャンク単位にまとめてHDF5へ書き込むワーカ。Noneで終了。"""
+    try:
+        buf   = np.empty((CHUNK_ROWS, W * H), dtype=np.uint16)
+        tsbuf = np.empty(CHUNK_ROWS, dtype="float64")
+        n = row = 0
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            buf[n], tsbuf[n] = item
+            n += 1
+            if n == CHUNK_ROWS:
+                row = flush_depth(ds_depth, ds_ts, buf, tsbuf, n, row)
+                n = 0
+        flush_depth(ds_depth, ds_ts, buf, tsbuf, n, row)
+    except Exception as e:
+        print(f"depth_worker 異常終了: {e}", file=sys.stderr)
+        worker_failed.set()
+
+def stop_workers(queues, threads):
+    """ワーカへ終了を通知して回収する。死んだワーカがいても固まらない。"""
+    for q in queues:
+        try:
+            q.put(None, timeout=2)
+        except queue.Full:
+            pass   # ワーカ死亡でキューが満杯のまま。daemon なので放置してよい
+    for t in threads:
+        t.join(timeout=10)
+
 def open_writer(path):
     fourcc = cv.VideoWriter_fourcc(*"mp4v")
-    return cv.VideoWriter(path, fourcc, FPS, (W, H), True)  # True=カラー(BGR)
+    # isColor=False: IRは1chのまま書き、GRAY→BGR の3倍化を省く
+    return cv.VideoWriter(path, fourcc, FPS, (W, H), False)
 
 # ---- ここがポイント：ウィンドウに“全体フィット（レターボックス）”して描画 ----
 def show_fit(win_name, img):
@@ -80,20 +251,56 @@ def show_fit(win_name, img):
     new_w = max(1, int(round(iw * scale)))
     new_h = max(1, int(round(ih * scale)))
 
+    # キャンバス/リサイズ先はウィンドウごとにキャッシュし、
+    # サイズが変わった時だけ確保し直す（毎フレームの確保をゼロに）
+    canvas_shape  = (win_h, win_w) if img.ndim == 2 else (win_h, win_w, img.shape[2])
+    resized_shape = (new_h, new_w) if img.ndim == 2 else (new_h, new_w, img.shape[2])
+    canvas, resized = show_fit.cache.get(win_name, (None, None))
+    if canvas is None or canvas.shape != canvas_shape or resized.shape != resized_shape:
+        canvas  = np.zeros(canvas_shape, dtype=np.uint8)   # 黒帯はここで一度だけ描く
+        resized = np.empty(resized_shape, dtype=np.uint8)
+        show_fit.cache[win_name] = (canvas, resized)
+
     interp = cv.INTER_NEAREST if new_w < iw or new_h < ih else cv.INTER_LINEAR
-    resized = cv.resize(img, (new_w, new_h), interpolation=interp)
+    cv.resize(img, (new_w, new_h), dst=resized, interpolation=interp)
 
-    if img.ndim == 2:
-        canvas = np.zeros((win_h, win_w), dtype=np.uint8)
-        y0 = (win_h - new_h) // 2; x0 = (win_w - new_w) // 2
-        canvas[y0:y0+new_h, x0:x0+new_w] = resized
-    else:
-        canvas = np.zeros((win_h, win_w, img.shape[2]), dtype=np.uint8)
-        y0 = (win_h - new_h) // 2; x0 = (win_w - new_w) // 2
-        canvas[y0:y0+new_h, x0:x0+new_w] = resized
+    y0 = (win_h - new_h) // 2; x0 = (win_w - new_w) // 2
+    canvas[y0:y0+new_h, x0:x0+new_w] = resized
 
     cv.imshow(win_name, canvas)
 
+show_fit.cache = {}  # win_name -> (canvas, resized)
+
+def preview_proc(shm_depth_name, shm_ir_name, stop_evt):
+    """プレビュー専用プロセス。
+
+    キャプチャ側は共有メモリへ最新フレームをmemcpyするだけで、
+    imshow/waitKey(GUIイベントポンプ・GIL保持)のコストを一切払わない。
+    'q' で stop_evt を立てて録画側に終了を伝える。
+    """
+    shm_d = shared_memory.SharedMemory(name=shm_depth_name)
+    shm_i = shared_memory.SharedMemory(name=shm_ir_name)
+    depth8  = np.ndarray((H, W), dtype=np.uint8, buffer=shm_d.buf)
+    ir_gray = np.ndarray((H, W), dtype=np.uint8, buffer=shm_i.buf)
+
+    cv.namedWindow("Depth-8bit", cv.WINDOW_NORMAL)
+    cv.setWindowProperty("Depth-8bit", cv.WND_PROP_ASPECT_RATIO, cv.WINDOW_FREERATIO)
+    cv.resizeWindow("Depth-8bit", W // 2, H // 2)
+
+    cv.namedWindow("IR", cv.WINDOW_NORMAL)
+    cv.setWindowProperty("IR", cv.WND_PROP_ASPECT_RATIO, cv.WINDOW_FREERATIO)
+    cv.resizeWindow("IR", W // 2, H // 2)
+
+    try:
+        while not stop_evt.is_set():
+            show_fit("Depth-8bit", depth8)
+            show_fit("IR", ir_gray)
+            if cv.waitKey(1000 // PREVIEW_FPS) & 0xFF == ord('q'):
+                stop_evt.set()
+    finally:
+        cv.destroyAllWindows()
+        shm_d.close(); shm_i.close()
+
 def quality_string():
     approx_depth_fps = FPS / SAVE_INTERVAL if SAVE_INTERVAL else float(FPS)
     return (
@@ -150,15 +357,18 @@ def main():
         pipe.wait_for_frames()
 
     if VISUALIZE:
-        cv.namedWindow("Depth-8bit", cv.WINDOW_NORMAL)
-        cv.setWindowProperty("Depth-8bit", cv.WND_PROP_ASPECT_RATIO, cv.WINDOW_FREERATIO)
-        cv.resizeWindow("Depth-8bit", W // 2, H // 2)
-
-        cv.namedWindow("IR", cv.WINDOW_NORMAL)
-        cv.setWindowProperty("IR", cv.WND_PROP_ASPECT_RATIO, cv.WINDOW_FREERATIO)
-        cv.resizeWindow("IR", W // 2, H // 2)
-
-    frame_id = 0
+        # 共有メモリ経由でプレビュープロセスへ最新フレームだけを渡す
+        shm_depth = shared_memory.SharedMemory(create=True, size=W * H)
+        shm_ir    = shared_memory.SharedMemory(create=True, size=W * H)
+        preview_depth = np.ndarray((H, W), dtype=np.uint8, buffer=shm_depth.buf)
+        preview_ir    = np.ndarray((H, W), dtype=np.uint8, buffer=shm_ir.buf)
+        preview_stop  = Event()
+        preview_p = Process(target=preview_proc,
+                            args=(shm_depth.name, shm_ir.name, preview_stop),
+                            daemon=True)
+        preview_p.start()
+
+    save_tick = 0  # 0 になったフレームだけ保存（剰余演算をループから排除）
     BLOCK_SECONDS = FILE_PERIOD_MIN * 60
     last_info_date = None  # 日付切り替えでINFOファイルを新規作成
 
@@ -187,11 +397,21 @@ def main():
             h5, ds_depth, ds_ts = open_h5(h5_path, dscale, serial, baby_id, pc_id, script_name)
             writer = open_writer(mp4_path)
             saved_depth = 0
-            block_start_time = time.time()
+            q_dropped = 0
+            block_end = time.monotonic() + BLOCK_SECONDS  # 終了時刻を先に計算
+
+            # ブロック単位のワーカスレッド（キューが詰まったらフレームは捨てる）
+            ir_q    = queue.Queue(maxsize=QUEUE_SIZE)
+            depth_q = queue.Queue(maxsize=QUEUE_SIZE)
+            ir_t    = threading.Thread(target=ir_worker, args=(ir_q, writer), daemon=True)
+            depth_t = threading.Thread(target=depth_worker, args=(depth_q, ds_depth, ds_ts), daemon=True)
+            ir_t.start(); depth_t.start()
 
             while True:
-                if time.time() - block_start_time > BLOCK_SECONDS:
+                if time.monotonic() > block_end:
                     break
+                if worker_failed.is_set():
+                    raise RuntimeError("書き込みワーカが停止しました（ディスク異常の可能性）")
                 try:
                     frames = pipe.wait_for_frames(timeout_ms=4000)
                 except RsErr:
@@ -202,39 +422,52 @@ def main():
                 if not dfrm or not ifrm:
                     continue
 
-                # --- depth を5fps保存 ---
-                if frame_id % SAVE_INTERVAL == 0:
-                    ds_depth.resize(ds_depth.shape[0]+1, 0)
-                    ds_ts.resize(ds_ts.shape[0]+1, 0)
-                    ds_depth[-1] = np.asarray(dfrm.get_data()).reshape(1, -1)
-                    ds_ts[-1]    = dfrm.get_timestamp()
-                    saved_depth += 1
-
-                # --- IR を動画に追加 (30fps) ---
-                ir_gray = np.asarray(ifrm.get_data(), dtype=np.uint8).reshape(H, W)
-                writer.write(cv.cvtColor(ir_gray, cv.COLOR_GRAY2BGR))
-
-                # --- 可視化 ---
-                if VISUALIZE and frame_id % SAVE_INTERVAL == 0:
-                    depth8 = depth_to_8bit(
-                        np.asarray(dfrm.get_data(), dtype=np.uint16).reshape(H, W)
-                    )
-                    show_fit("Depth-8bit", depth8)
-                    show_fit("IR", ir_gray)
-                    if cv.waitKey(1) & 0xFF == ord('q'):
-                        raise KeyboardInterrupt
+                # フレームのビューは1回だけ取得し、保存/可視化の両方で使い回す
+                depth_1d = np.frombuffer(dfrm.get_data(), dtype=np.uint16)
+                ir_gray  = np.frombuffer(ifrm.get_data(), dtype=np.uint8).reshape(H, W)
 
-                frame_id += 1
+                do_save = save_tick == 0
+                save_tick = SAVE_INTERVAL - 1 if do_save else save_tick - 1
+
+                # --- depth を5fps保存（ワーカへ引き渡し） ---
+                if do_save:
+                    try:
+                        # copy() でRealSense側バッファから切り離してから渡す
+                        depth_q.put_nowait((depth_1d.copy(), dfrm.get_timestamp()))
+                        saved_depth += 1
+                    except queue.Full:
+                        q_dropped += 1
+
+                # --- IR を動画に追加 (30fps・ワーカへ引き渡し) ---
+                try:
+                    ir_q.put_nowait(ir_gray.copy())
+                except queue.Full:
+                    q_dropped += 1
+
+                # --- 可視化（共有メモリへのmemcpyのみ。表示は別プロセス） ---
+                if VISUALIZE and do_save:
+                    np.copyto(preview_depth, depth_to_8bit(depth_1d.reshape(H, W)))
+                    np.copyto(preview_ir, ir_gray)
+                    if preview_stop.is_set():   # プレビュー側で 'q'
+                        raise KeyboardInterrupt
 
-            # ---- ブロック終了 ----
-            h5.attrs.update({"end_ts_sys": time.time(), "depth_frames": saved_depth})
+            # ---- ブロック終了（ワーカを止めて書き切る） ----
+            stop_workers((ir_q, depth_q), (ir_t, depth_t))
             h5.close(); writer.release()
+            finalize_h5(h5_path, {"end_ts_sys": time.time(),
+                                  "depth_frames": saved_depth,
+                                  "queue_dropped": q_dropped},
+                        depth_rows=saved_depth)
             print(f"▲ 保存完了: {h5_path} (depth {saved_depth}f) + {mp4_path}")
 
     except KeyboardInterrupt:
         print("\nユーザー停止")
     finally:
-        if VISUALIZE: cv.destroyAllWindows()
+        if VISUALIZE:
+            preview_stop.set()
+            preview_p.join(timeout=2)
+            shm_depth.close(); shm_ir.close()
+            shm_depth.unlink(); shm_ir.unlink()
         pipe.stop(); print("パイプライン停止完了")
 
 if __name__ == "__main__":
@@ -14,7 +14,9 @@ RGB        : 1920 × 1080 @ 30 fps (L515 最大)
 """
 
 import os
+import queue
 import sys
+import threading
 import time
 import numpy as np
 import cv2 as cv
@@ -26,6 +28,9 @@ IR_W,  IR_H      = 1024, 768         # IR 解像度 (Max)
 RGB_W, RGB_H     = 1920, 1080        # RGB 解像度 (Max)
 FPS              = 30                # 共通フレームレート
 FILE_PERIOD_MIN  = 1                 # 何分ごとにファイル分割するか
+QUEUE_SIZE       = 4                 # 書き込みワーカへのキュー段数
+RS_QUEUE_SIZE    = 1                 # librealsense 内部キュー（最新フレーム優先）
+PREVIEW_INTERVAL = 6                 # 何フレームごとにプレビュー更新するか
 VISUALIZE        = True              # GUI プレビュー
 # ---------------------------
 
@@ -48,6 +53,11 @@ def init_pipe():
     if not ctx.devices:
         raise RuntimeError("L515 が接続されていません。")
 
+    # センサ内部キューを絞り、古いフレームを抱え込まず常に最新を受け取る
+    for s in ctx.devices[0].query_sensors():
+        if s.supports(rs.option.frames_queue_size):
+            s.set_option(rs.option.frames_queue_size, RS_QUEUE_SIZE)
+
     pipe, cfg = rs.pipeline(), rs.config()
     cfg.enable_stream(rs.stream.infrared, IR_W, IR_H, rs.format.y8, FPS)
     cfg.enable_stream(rs.stream.color,    RGB_W, RGB_H, rs.format.bgr8, FPS)
@@ -59,9 +69,53 @@ def init_pipe():
     return pipe, serial
 
 
-def open_writer(path: str, width: int, height: int):
+def open_writer(path: str, width: int, height: int, is_color: bool = True):
     fourcc = cv.VideoWriter_fourcc(*"mp4v")
-    return cv.VideoWriter(path, fourcc, FPS, (width, height), True)
+    return cv.VideoWriter(path, fourcc, FPS, (width, height), is_color)
+
+
+# ---- 書き込みワーカ（キャプチャスレッドをエンコードで止めないため分離） ----
+
+# ワーカ例外の通知。ディスクフル等でワーカが死ぬとキューが満杯のまま残り、
+# 終了処理の put(None)/join が永久に固まるため、キャプチャループが監視する
+worker_failed = threading.Event()
+
+
+def ir_worker(q: queue.Queue, writer) -> None:
+    """IR フレームをそのまま（1ch GRAY）MP4 へ書き込むワーカ。None で終了。"""
+    try:
+        while True:
+            ir_gray = q.get()
+            if ir_gray is None:
+                break
+            writer.write(ir_gray)
+    except Exception as e:
+        print(f"ir_worker 異常終了: {e}", file=sys.stderr)
+        worker_failed.set()
+
+
+def rgb_worker(q: queue.Queue, writer) -> None:
+    """RGB フレームを MP4 へ書き込むワーカ。None で終了。"""
+    try:
+        while True:
+            rgb_img = q.get()
+            if rgb_img is None:
+                break
+            writer.write(rgb_img)
+    except Exception as e:
+        print(f"rgb_worker 異常終了: {e}", file=sys.stderr)
+        worker_failed.set()
+
+
+def stop_workers(queues, threads) -> None:
+    """ワーカへ終了を通知して回収する。死んだワーカがいても固まらない。"""
+    for q in queues:
+        try:
+            q.put(None, timeout=2)
+        except queue.Full:
+            pass   # ワーカ死亡でキューが満杯のまま。daemon なので放置してよい
+    for t in threads:
+        t.join(timeout=10)
 
 
 def main():
@@ -109,40 +163,70 @@ def main():
                     f.write(f"start_ts_sys : {time.time()}\n")
                 first_block = False
 
-            ir_writer  = open_writer(mp4_ir_path,  IR_W,  IR_H)
+            # IR は 1ch のまま書く（GRAY→BGR の3倍化を省く）
+            ir_writer  = open_writer(mp4_ir_path,  IR_W,  IR_H, is_color=False)
             rgb_writer = open_writer(mp4_rgb_path, RGB_W, RGB_H)
-            block_start = time.time()
+            block_end = time.monotonic() + BLOCK_SECONDS  # 終了時刻を先に計算
+            frame_id = 0
+            dropped = 0
+            q_dropped = 0
             print("▶ 新ブロック:", prefix)
 
+            # ブロック単位のワーカスレッド（キューが詰まったらフレームは捨てる）
+            ir_q  = queue.Queue(maxsize=QUEUE_SIZE)
+            rgb_q = queue.Queue(maxsize=QUEUE_SIZE)
+            ir_t  = threading.Thread(target=ir_worker,  args=(ir_q, ir_writer),   daemon=True)
+            rgb_t = threading.Thread(target=rgb_worker, args=(rgb_q, rgb_writer), daemon=True)
+            ir_t.start(); rgb_t.start()
+
             try:
-                while time.time() - block_start <= BLOCK_SECONDS:
+                while time.monotonic() <= block_end:
+                    if worker_failed.is_set():
+                        raise RuntimeError("書き込みワーカが停止しました（ディスク異常の可能性）")
                     try:
                         frames = pipe.wait_for_frames(timeout_ms=3000)
                     except RsErr:
                         continue
 
+                    # 処理が遅れた分は最新フレームまで読み飛ばす（遅延蓄積防止）
+                    while True:
+                        newer = pipe.poll_for_frames()
+                        if not newer:
+                            break
+                        frames = newer
+                        dropped += 1
+
                     ifrm = frames.get_infrared_frame()
                     cfrm = frames.get_color_frame()
                     if not ifrm or not cfrm:
                         continue
 
-                    # 書き込み
+                    # 書き込み（copy() で RealSense 側バッファから切り離して渡す）
                     ir_gray = np.asanyarray(ifrm.get_data()).reshape(IR_H, IR_W)
-                    ir_writer.write(cv.cvtColor(ir_gray, cv.COLOR_GRAY2BGR))
+                    try:
+                        ir_q.put_nowait(ir_gray.copy())
+                    except queue.Full:
+                        q_dropped += 1
 
                     rgb_img = np.asanyarray(cfrm.get_data())
-                    rgb_writer.write(rgb_img)
+                    try:
+                        rgb_q.put_nowait(rgb_img.copy())
+                    except queue.Full:
+                        q_dropped += 1
 
-                    # プレビュー
-                    if VISUALIZE:
+                    # プレビュー（waitKey は GUI イベントポンプを兼ねるので間引く）
+                    if VISUALIZE and frame_id % PREVIEW_INTERVAL == 0:
                         cv.imshow("IR",  ir_gray)
                         cv.imshow("RGB", rgb_img)
                         if cv.waitKey(1) & 0xFF == ord('q'):
                             raise KeyboardInterrupt
+                    frame_id += 1
 
             finally:
+                stop_workers((ir_q, rgb_q), (ir_t, rgb_t))
                 ir_writer.release(); rgb_writer.release()
-                print(f"▲ 保存完了: {mp4_ir_path} + {mp4_rgb_path}")
+                print(f"▲ 保存完了: {mp4_ir_path} + {mp4_rgb_path} "
+                      f"(drop {dropped}f / queue {q_dropped}f)")
 
     except KeyboardInterrupt:
         print("\nユーザー停止")
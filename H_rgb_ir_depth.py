@@ -14,7 +14,9 @@ ROOT_PATH/babyID/DATE/<prefix>_info.txt          (セッション開始時のみ
 
 from __future__ import annotations
 import os
+import queue
 import sys
+import threading
 import time
 import numpy as np
 import cv2 as cv
@@ -22,6 +24,16 @@ import h5py
 import pyrealsense2 as rs
 from datetime import datetime, timezone
 
+try:
+    import av  # PyAV は任意依存（あればハードウェア H.264 へ逃がす）
+except ImportError:
+    av = None
+
+try:
+    import hdf5plugin  # 任意依存（あれば depth を Blosc2(zstd) で圧縮）
+except ImportError:
+    hdf5plugin = None
+
 # -------- ユーザ設定 --------
 ROOT_PATH        = r"D:/Dev/Data"         # データ保存先ルート
 DEPTH_W, DEPTH_H = 1024, 768              # Depth 解像度 (Max)
@@ -29,6 +41,11 @@ IR_W,    IR_H    = 1024, 768              # IR   解像度 (Max)
 RGB_W,   RGB_H   = 1920, 1080             # RGB  解像度 (Max)
 FPS              = 30                     # 共通フレームレート
 FILE_PERIOD_MIN  = 1                      # 何分ごとにファイル分割
+CHUNK_ROWS       = 2                      # HDF5 チャンク行数（2×1024×768×2B ≈ 3MB）
+USE_NVENC        = True                   # CUDA 対応 OpenCV なら NVENC でエンコード
+AV_CODEC         = "h264_qsv"             # PyAV 用コーデック（NVIDIA 機は "h264_nvenc"）
+QUEUE_SIZE       = 4                      # 書き込みワーカへのキュー段数
+RS_QUEUE_SIZE    = 1                      # librealsense 内部キュー（最新フレーム優先）
 VISUALIZE        = False                  # GUI プレビュー
 # ---------------------------
 
@@ -42,6 +59,11 @@ while not pc_name.strip():
 
 RsErr = rs.error if hasattr(rs, "error") else Exception
 
+# 属性は複合型でまとめて書き、ファイルオープンごとの H5Awrite 回数を抑える
+META_DT = np.dtype([
+    ("depth_scale", "f8"), ("width", "i4"), ("height", "i4"), ("fps", "i4"),
+])
+
 # ---------- ヘルパ ----------
 
 def mkdir(path: str):
@@ -56,10 +78,17 @@ def init_pipe():
     dev = ctx.devices[0]
     firmware = dev.get_info(rs.camera_info.firmware_version)
 
+    # センサ内部キューを絞り、古いフレームを抱え込まず常に最新を受け取る
+    for s in dev.query_sensors():
+        if s.supports(rs.option.frames_queue_size):
+            s.set_option(rs.option.frames_queue_size, RS_QUEUE_SIZE)
+
     pipe, cfg = rs.pipeline(), rs.config()
     cfg.enable_stream(rs.stream.depth,    DEPTH_W, DEPTH_H, rs.format.z16,  FPS)
     cfg.enable_stream(rs.stream.infrared, IR_W,    IR_H,    rs.format.y8,   FPS)
-    cfg.enable_stream(rs.stream.color,    RGB_W,   RGB_H,   rs.format.bgr8, FPS)
+    # YUYV ならセンサ出力をそのまま受け取り、librealsense の BGR 変換を省く
+    rgb_format = rs.format.yuyv if use_yuyv_rgb() else rs.format.bgr8
+    cfg.enable_stream(rs.stream.color,    RGB_W,   RGB_H,   rgb_format, FPS)
 
     cfg.resolve(rs.pipeline_wrapper(pipe))
     prof = pipe.start(cfg)
@@ -69,7 +98,144 @@ def init_pipe():
     return pipe, serial, firmware, dscale
 
 
-def open_writer(path: str, width: int, height: int) -> cv.VideoWriter:
+_nvenc_available: bool | None = None
+
+
+def nvenc_available() -> bool:
+    """cv.cudacodec（NVENC）が使えるビルドかを一度だけ判定してキャッシュ。"""
+    global _nvenc_available
+    if _nvenc_available is None:
+        try:
+            _nvenc_available = (hasattr(cv, "cudacodec")
+                                and cv.cuda.getCudaEnabledDeviceCount() > 0)
+        except Exception:
+            _nvenc_available = False
+    return _nvenc_available
+
+
+class NvencWriter:
+    """cv.cudacodec.VideoWriter の薄いラッパ（cv.VideoWriter 互換 API）。
+
+    エンコードを NVENC（専用 ASIC）へ逃がし、CPU を HDF5 書き込みに残す。
+    """
+
+    def __init__(self, path: str, width: int, height: int):
+        params = cv.cudacodec.EncoderParams()
+        params.tuningInfo = cv.cudacodec.ENC_TUNING_INFO_LOW_LATENCY
+        params.rateControlMode = cv.cudacodec.ENC_PARAMS_RC_VBR
+        params.targetQuality = 28
+        params.gopLength = FPS * 2
+        self._writer = cv.cudacodec.createVideoWriter(
+            path, (width, height), cv.cudacodec.H264, FPS,
+            cv.cudacodec.ColorFormat_BGR, params)
+        self._gpu = cv.cuda_GpuMat()
+
+    def write(self, frame: np.ndarray) -> None:
+        self._gpu.upload(frame)
+        self._writer.write(self._gpu)
+
+    def release(self) -> None:
+        self._writer.release()
+
+
+_av_encoder_usable: bool | None = None
+
+
+def av_encoder_usable() -> bool:
+    """AV_CODEC が実際に開けるかを一度だけ試してキャッシュ。
+
+    h264_qsv などはビルドに存在しても実機に HW が無いと open で失敗する。
+    null 出力へダミーのストリームを開いて確認する（ファイルは作られない）。
+    """
+    global _av_encoder_usable
+    if _av_encoder_usable is None:
+        try:
+            with av.open(os.devnull, "w", format="null") as c:
+                s = c.add_stream(AV_CODEC, rate=FPS)
+                s.width, s.height = RGB_W, RGB_H
+                s.pix_fmt = "nv12"
+                s.codec_context.open()
+            _av_encoder_usable = True
+        except Exception:
+            _av_encoder_usable = False
+    return _av_encoder_usable
+
+
+def use_yuyv_rgb() -> bool:
+    """RGB をセンサネイティブの YUYV のまま流せる構成か。
+
+    エンコーダはどのみち YUV を要求するため、PyAV(libswscale) 経由なら
+    librealsense の YUYV→BGR 変換とエンコーダの BGR→YUV 変換を両方省ける。
+    NVENC(cudacodec) パスは BGR 入力なので対象外。YUYV パスには
+    フォールバック先が無いため、AV_CODEC が開けることまで確認してから選ぶ
+    （開けなければ BGR ストリーム＋従来のフォールバック連鎖に落ちる）。
+    """
+    if av is None or (USE_NVENC and nvenc_available()):
+        return False
+    return av_encoder_usable()
+
+
+class PyAvWriter:
+    """PyAV(libav) 経由の H.264 ライタ（cv.VideoWriter 互換 API）。
+
+    mp4v(MPEG-4 Part 2 ソフトエンコード) よりビットレート効率・CPU 負荷とも
+    大幅に有利。AV_CODEC にハードウェアエンコーダを指定すれば ALU をほぼ使わない。
+    """
+
+    def __init__(self, path: str, width: int, height: int, src_format: str = "bgr24"):
+        self._container = av.open(path, "w")
+        self._stream = self._container.add_stream(AV_CODEC, rate=FPS)
+        self._stream.width = width
+        self._stream.height = height
+        self._stream.pix_fmt = "nv12"
+        self._stream.options = {"preset": "veryfast", "global_quality": "23"}
+        self._src_format = src_format
+        # ここで開いておかないと最初の encode()（ワーカスレッド上）まで
+        # 失敗が遅延し、open_writer のフォールバック連鎖が効かない
+        # （QSV 等の HW エンコーダはビルドに居ても HW 無しだと open で失敗する）
+        self._stream.codec_context.open()
+
+    def write(self, frame: np.ndarray) -> None:
+        vf = av.VideoFrame.from_ndarray(frame, format=self._src_format)
+        for pkt in self._stream.encode(vf):
+            self._container.mux(pkt)
+
+    def release(self) -> None:
+        for pkt in self._stream.encode():  # エンコーダ内の残りを吐き出す
+            self._container.mux(pkt)
+        self._container.close()
+
+
+def open_writer(path: str, width: int, height: int,
+                yuyv: bool = False, gray: bool = False):
+    if yuyv:
+        # YUYV 入力は PyAV(libswscale) のみ対応（use_yuyv_rgb で選択済み）
+        return PyAvWriter(path, width, height, src_format="yuyv422")
+    if gray:
+        # IR は 1ch のまま書く（GRAY→BGR の3倍化を省く）。NVENC は NV12/BGR
+        # 入力しか受けないため対象外
+        if av is not None:
+            try:
+                return PyAvWriter(path, width, height, src_format="gray")
+            except Exception as e:
+                print(f"PyAV(gray) 初期化失敗（CPU エンコードへフォールバック）: {e}",
+                      file=sys.stderr)
+        writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*"mp4v"),
+                                FPS, (width, height), False)
+        if not writer.isOpened():
+            raise IOError(f"VideoWriter open failed: {path}")
+        return writer
+    if USE_NVENC and nvenc_available():
+        try:
+            return NvencWriter(path, width, height)
+        except Exception as e:
+            print(f"NVENC 初期化失敗（次の候補へフォールバック）: {e}", file=sys.stderr)
+    if av is not None:
+        try:
+            return PyAvWriter(path, width, height)
+        except Exception as e:
+            print(f"PyAV({AV_CODEC}) 初期化失敗（CPU エンコードへフォールバック）: {e}",
+                  file=sys.stderr)
     fourcc = cv.VideoWriter_fourcc(*"mp4v")  # 環境依存。必要なら 'avc1' などへ変更
     writer = cv.VideoWriter(path, fourcc, FPS, (width, height), True)
     if not writer.isOpened():
@@ -77,20 +243,127 @@ def open_writer(path: str, width: int, height: int) -> cv.VideoWriter:
     return writer
 
 
+def depth_compression():
+    """depth データセット用の圧縮設定（create_dataset のキーワード）を返す。
+
+    hdf5plugin があれば Blosc2(zstd, bitshuffle)、無ければ shuffle+LZF。
+    """
+    if hdf5plugin is not None:
+        return dict(hdf5plugin.Blosc2(cname="zstd", clevel=3,
+                                      filters=hdf5plugin.Blosc2.BITSHUFFLE))
+    return {"compression": "lzf", "shuffle": True}
+
+
 def open_h5(path: str, dscale: float, serial: str):
     cols = DEPTH_W * DEPTH_H
-    f = h5py.File(path, "w")
-    f.attrs.update({
-        "depth_scale": dscale,
-        "width": DEPTH_W, "height": DEPTH_H,
-        "fps": FPS,
-        "serial": serial,
-    })
-    dset = f.create_dataset("depth", (0, cols), maxshape=(None, cols),
-                           dtype="uint16", chunks=(1, cols))
-    ts   = f.create_dataset("ts", (0,), maxshape=(None,), dtype="float64")
+    # ページ割り当て＋大きめのチャンクキャッシュで、細かいメタデータ書き込みを
+    # 1MB ページ単位にまとめてからディスクへ流す（NTFS の小書き込みが特に遅いため）
+    f = h5py.File(path, "w", libver="latest",
+                  rdcc_nbytes=32 * 1024 * 1024, rdcc_nslots=10007,
+                  fs_strategy="page", fs_page_size=1024 * 1024)
+    f.attrs["meta"]   = np.array((dscale, DEPTH_W, DEPTH_H, FPS), dtype=META_DT)
+    f.attrs["serial"] = serial
+    # ブロック長ぶんを先に確保し、ループ中の resize（B-tree 更新）をなくす
+    max_rows = FILE_PERIOD_MIN * 60 * FPS + 8
+    # Blosc2(zstd)（hdf5plugin があれば）または shuffle+LZF で圧縮（depth は 2〜3 倍以上縮む）
+    dset = f.create_dataset("depth", (max_rows, cols), maxshape=(None, cols),
+                           dtype="uint16", chunks=(CHUNK_ROWS, cols),
+                           **depth_compression())
+    ts   = f.create_dataset("ts", (max_rows,), maxshape=(None,), dtype="float64")
     return f, dset, ts
 
+
+def flush_depth(dset, ts, buf, tsbuf, n, row):
+    """バッファ済み depth フレームを row 以降へまとめて書き、次の行番号を返す。"""
+    if n == 0:
+        return row
+    if row + n > dset.shape[0]:  # 予約分を超えた時だけ伸長（通常は起きない）
+        dset.resize(row + n, 0)
+        ts.resize(row + n, 0)
+    if (n == CHUNK_ROWS and row % CHUNK_ROWS == 0
+            and dset.id.get_create_plist().get_nfilters() == 0):
+        # 無圧縮かつチャンク丸ごとなら h5py の選択機構を介さず直接書き込む
+        dset.id.write_direct_chunk((row, 0), buf.tobytes())
+    else:
+        dset[row:row + n] = buf[:n]
+    ts[row:row + n] = tsbuf[:n]
+    return row + n
+
+
+def finalize_h5(path: str, end_attrs: dict, depth_rows: int | None = None):
+    """ブロッククローズ後に開き直し、末尾トリムと終了属性をまとめて書く。"""
+    with h5py.File(path, "a") as f:
+        if depth_rows is not None:
+            f["depth"].resize(depth_rows, 0)
+            f["ts"].resize(depth_rows, 0)
+        f.attrs.update(end_attrs)
+
+
+# ---------- 書き込みワーカ（キャプチャスレッドを I/O で止めないため分離） ----------
+
+# ワーカ例外の通知。ディスクフル等でワーカが死ぬとキューが満杯のまま残り、
+# 終了処理の put(None)/join が永久に固まるため、キャプチャループが監視して
+# 録画を（従来どおり）大きな音を立てて止める
+worker_failed = threading.Event()
+
+
+def ir_worker(q: queue.Queue, writer) -> None:
+    """IR フレームをそのまま（1ch GRAY）MP4 へ書き込むワーカ。None で終了。"""
+    try:
+        while True:
+            ir_gray = q.get()
+            if ir_gray is None:
+                break
+            writer.write(ir_gray)
+    except Exception as e:
+        print(f"ir_worker 異常終了: {e}", file=sys.stderr)
+        worker_failed.set()
+
+
+def rgb_worker(q: queue.Queue, writer) -> None:
+    """RGB フレームを MP4 へ書き込むワーカ。None で終了。"""
+    try:
+        while True:
+            rgb_img = q.get()
+            if rgb_img is None:
+                break
+            writer.write(rgb_img)
+    except Exception as e:
+        print(f"rgb_worker 異常終了: {e}", file=sys.stderr)
+        worker_failed.set()
+
+
+def depth_worker(q: queue.Queue, dset, ts) -> None:
+    """depth フレームをチャンク単位にまとめて HDF5 へ書き込むワーカ。None で終了。"""
+    buf   = np.empty((CHUNK_ROWS, DEPTH_W * DEPTH_H), dtype=np.uint16)
+    tsbuf = np.empty(CHUNK_ROWS, dtype="float64")
+    n = row = 0
+    try:
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            buf[n], tsbuf[n] = item
+            n += 1
+            if n == CHUNK_ROWS:
+                row = flush_depth(dset, ts, buf, tsbuf, n, row)
+                n = 0
+        flush_depth(dset, ts, buf, tsbuf, n, row)
+    except Exception as e:
+        print(f"depth_worker 異常終了: {e}", file=sys.stderr)
+        worker_failed.set()
+
+
+def stop_workers(queues, threads) -> None:
+    """ワーカへ終了を通知して回収する。死んだワーカがいても固まらない。"""
+    for q in queues:
+        try:
+            q.put(None, timeout=2)
+        except queue.Full:
+            pass   # ワーカ死亡でキューが満杯のまま。daemon なので放置してよい
+    for t in threads:
+        t.join(timeout=10)
+
 # ---------- メイン ----------
 
 def main():
@@ -147,55 +420,98 @@ def main():
                 last_info_date = date_str
 
             # --- Writer / HDF5 open ---
-            ir_writer  = open_writer(mp4_ir,  IR_W,  IR_H)
-            rgb_writer = open_writer(mp4_rgb, RGB_W, RGB_H)
+            rgb_yuyv   = use_yuyv_rgb()
+            ir_writer  = open_writer(mp4_ir,  IR_W,  IR_H, gray=True)
+            rgb_writer = open_writer(mp4_rgb, RGB_W, RGB_H, yuyv=rgb_yuyv)
             h5f, dset_depth, dset_ts = open_h5(h5_path, dscale, serial)
 
-            block_start = time.monotonic()
+            block_end   = time.monotonic() + BLOCK_SECONDS  # 終了時刻を先に計算
             frame_id    = 0
+            dropped     = 0
+            q_dropped   = 0
+            depth_saved = 0
             print("▶ 新ブロック:", prefix)
 
+            # ブロック単位のワーカスレッド（キューが詰まったらフレームは捨てる）
+            ir_q    = queue.Queue(maxsize=QUEUE_SIZE)
+            rgb_q   = queue.Queue(maxsize=QUEUE_SIZE)
+            depth_q = queue.Queue(maxsize=QUEUE_SIZE)
+            workers = [
+                threading.Thread(target=ir_worker,    args=(ir_q, ir_writer),   daemon=True),
+                threading.Thread(target=rgb_worker,   args=(rgb_q, rgb_writer), daemon=True),
+                threading.Thread(target=depth_worker, args=(depth_q, dset_depth, dset_ts), daemon=True),
+            ]
+            for t in workers:
+                t.start()
+
             try:
-                while time.monotonic() - block_start <= BLOCK_SECONDS:
+                while time.monotonic() <= block_end:
+                    if worker_failed.is_set():
+                        raise RuntimeError("書き込みワーカが停止しました（ディスク異常の可能性）")
                     try:
                         frames = pipe.wait_for_frames(timeout_ms=3000)
                     except RsErr:
                         continue
 
+                    # 処理が遅れた分は最新フレームまで読み飛ばす（遅延蓄積防止）
+                    while True:
+                        newer = pipe.poll_for_frames()
+                        if not newer:
+                            break
+                        frames = newer
+                        dropped += 1
+
                     dfrm = frames.get_depth_frame()
                     ifrm = frames.get_infrared_frame()
                     cfrm = frames.get_color_frame()
                     if not (dfrm and ifrm and cfrm):
                         continue
 
-                    # --- Depth 保存 (全フレーム) ---
-                    depth = np.asanyarray(dfrm.get_data())      # (H,W) uint16
-                    dset_depth.resize(dset_depth.shape[0] + 1, 0)
-                    dset_ts.resize(dset_ts.shape[0] + 1, 0)
-                    dset_depth[-1] = depth.reshape(1, -1)
-                    dset_ts[-1]    = dfrm.get_timestamp()
-
-                    # --- IR 保存 (MP4) ---
-                    ir_gray = np.asanyarray(ifrm.get_data())    # (H,W) uint8
-                    ir_writer.write(cv.cvtColor(ir_gray, cv.COLOR_GRAY2BGR))
+                    # --- Depth 保存 (全フレーム・ワーカへ引き渡し) ---
+                    # frombuffer はゼロコピーのビュー（asanyarray はコピーし得る）
+                    depth = np.frombuffer(dfrm.get_data(), dtype=np.uint16)  # 1-D view
+                    try:
+                        # copy() で RealSense 側バッファから切り離してから渡す
+                        depth_q.put_nowait((depth.copy(), dfrm.get_timestamp()))
+                        depth_saved += 1
+                    except queue.Full:
+                        q_dropped += 1
+
+                    # --- IR 保存 (MP4・ワーカへ引き渡し) ---
+                    ir_gray = np.frombuffer(ifrm.get_data(), dtype=np.uint8).reshape(IR_H, IR_W)
+                    try:
+                        ir_q.put_nowait(ir_gray.copy())
+                    except queue.Full:
+                        q_dropped += 1
 
-                    # --- RGB 保存 (MP4) ---
-                    rgb_img = np.asanyarray(cfrm.get_data())    # (H,W,3) uint8
-                    rgb_writer.write(rgb_img)
+                    # --- RGB 保存 (MP4・ワーカへ引き渡し) ---
+                    rgb_ch  = 2 if rgb_yuyv else 3   # YUYV は 2 byte/pixel
+                    rgb_img = np.frombuffer(cfrm.get_data(), dtype=np.uint8).reshape(RGB_H, RGB_W, rgb_ch)
+                    try:
+                        rgb_q.put_nowait(rgb_img.copy())
+                    except queue.Full:
+                        q_dropped += 1
 
                     # --- プレビュー ---
                     if VISUALIZE and frame_id % 2 == 0:
-                        depth8 = cv.convertScaleAbs(depth, alpha=0.03)  # 粗 8‑bit 表示
+                        depth2d = depth.reshape(DEPTH_H, DEPTH_W)       # 同じビューを再利用
+                        depth8 = cv.convertScaleAbs(depth2d, alpha=0.03)  # 粗 8‑bit 表示
                         cv.imshow("Depth8", depth8)
                         cv.imshow("IR",     ir_gray)
-                        cv.imshow("RGB",    rgb_img)
+                        # プレビューのみ BGR へ変換（保存パスは変換なし）
+                        cv.imshow("RGB", cv.cvtColor(rgb_img, cv.COLOR_YUV2BGR_YUY2)
+                                         if rgb_yuyv else rgb_img)
                         if cv.waitKey(1) & 0xFF == ord('q'):
                             raise KeyboardInterrupt
                     frame_id += 1
 
             finally:
+                stop_workers((ir_q, rgb_q, depth_q), workers)
                 h5f.close(); ir_writer.release(); rgb_writer.release()
-                print(f"▲ 保存完了: {h5_path} + {mp4_ir} + {mp4_rgb}")
+                finalize_h5(h5_path, {"dropped_frames": dropped,
+                                      "queue_dropped": q_dropped},
+                            depth_rows=depth_saved)
+                print(f"▲ 保存完了: {h5_path} + {mp4_ir} + {mp4_rgb} (drop {dropped}f)")
 
     except KeyboardInterrupt:
         print("\nユーザー停止")
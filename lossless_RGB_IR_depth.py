@@ -8,9 +8,27 @@ Intel RealSense L515 — Depth+IR 30 fps / RGB 6 fps 録画スクリプト
 """
 
 from __future__ import annotations
-import os, sys, time, numpy as np, cv2 as cv, h5py, pyrealsense2 as rs
+import os, struct, sys, time, queue, threading
+import numpy as np, cv2 as cv, h5py, pyrealsense2 as rs
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
+try:
+    import hdf5plugin  # 任意依存（あれば depth を bitshuffle+LZ4 で可逆圧縮）
+except ImportError:
+    hdf5plugin = None
+
+try:
+    import bitshuffle  # 任意依存（あれば圧縮をワーカ外のスレッドプールで先行実行）
+except ImportError:
+    bitshuffle = None
+
+try:
+    from numba import njit  # 任意依存（あればリングへのコピーを nogil 化）
+except ImportError:
+    njit = None
+
 # -------- ユーザ設定 --------
 ROOT_PATH         = r"D:/Dev/Data"
 DEPTH_W, DEPTH_H  = 1024, 768
@@ -19,8 +37,16 @@ RGB_W,   RGB_H    = 1280, 720
 DEPTH_FPS = IR_FPS = 30
 RGB_FPS            = 6
 BLOCK_SEC          = 60
+BATCH_FRAMES       = 30               # depth/ts をこの枚数ずつまとめて書く
+DEPTH_SHIFT        = 0                # 下位ビット切り捨て量。>0 で uint8 保存（非可逆）。
+                                      # 0 なら従来どおり uint16 可逆。分解能は
+                                      # depth_scale × 2**DEPTH_SHIFT（属性に反映される）
+USE_NVENC          = True             # GStreamer+NVENC 対応 OpenCV ならハードウェアエンコード
+RECORD_BAG         = False            # True なら SDK の rosbag 録画のみ（エンコード・HDF5 無し）。
+                                      # 変換は transcode_bag.py でオフラインに行う
 VISUALIZE          = False
 QUEUE_SIZE         = 32
+WQ_SIZE            = 8                # 書き込みワーカへのキュー段数（満杯時はブロックして無欠損）
 # ---------------------------
 
 # ==== babyID / PCname ====
@@ -36,58 +62,365 @@ for s in dev.query_sensors():
         s.set_option(rs.option.frames_queue_size, QUEUE_SIZE)
 
 # --- Depth / IR pipeline ---
+# フレームは rs.frame_queue 経由で受け取る（keep_frames=True で librealsense が
+# 回収しないよう keep 済み）。ブロッキング待ちを SDK 側キューに寄せ、
+# 取りこぼしを SDK のキュー深さで吸収する
 pipe, cfg = rs.pipeline(), rs.config()
 cfg.enable_stream(rs.stream.depth, DEPTH_W, DEPTH_H, rs.format.z16, DEPTH_FPS)
 cfg.enable_stream(rs.stream.infrared, IR_W, IR_H, rs.format.y8, IR_FPS)
-prof = pipe.start(cfg)
+if RECORD_BAG:
+    # SDK 内の memcpy だけで .bag に書く。エンコーダ/HDF5 と CPU を奪い合わない。
+    # RGB もパイプラインに入れて bag へ含める（通常録画ではセンサ直叩きだが、
+    # recorder はパイプライン経由のストリームしか記録しない）
+    cfg.enable_stream(rs.stream.color, RGB_W, RGB_H, rs.format.bgr8, RGB_FPS)
+    bag_dir = os.path.join(ROOT_PATH, baby_id, "BAG")
+    os.makedirs(bag_dir, exist_ok=True)
+    bag_path = os.path.join(bag_dir, time.strftime("%Y%m%d_%H%M%S") + ".bag")
+    cfg.enable_record_to_file(bag_path)
+q_frames = rs.frame_queue(QUEUE_SIZE, keep_frames=True)
+prof = pipe.start(cfg, q_frames)
 serial   = dev.get_info(rs.camera_info.serial_number)
 firmware = dev.get_info(rs.camera_info.firmware_version)
 dscale   = dev.first_depth_sensor().get_depth_scale()
 
-# --- RGB sensor 6 fps ---
-color_sensor = next(s for s in dev.query_sensors()
-                    if s.get_info(rs.camera_info.name) == "RGB Camera")
-rgb_prof = next(p for p in color_sensor.get_stream_profiles()
-                if p.fps() == RGB_FPS and
-                   p.as_video_stream_profile().width()  == RGB_W and
-                   p.as_video_stream_profile().height() == RGB_H)
-q_rgb = rs.frame_queue(QUEUE_SIZE)
-color_sensor.open(rgb_prof)
-color_sensor.start(lambda f: q_rgb.enqueue(f))
+# --- RGB sensor 6 fps（BAG 録画時はパイプライン側で記録するので使わない） ---
+if not RECORD_BAG:
+    color_sensor = next(s for s in dev.query_sensors()
+                        if s.get_info(rs.camera_info.name) == "RGB Camera")
+    rgb_prof = next(p for p in color_sensor.get_stream_profiles()
+                    if p.fps() == RGB_FPS and
+                       p.as_video_stream_profile().width()  == RGB_W and
+                       p.as_video_stream_profile().height() == RGB_H)
+    q_rgb = rs.frame_queue(QUEUE_SIZE)
+    color_sensor.open(rgb_prof)
+    color_sensor.start(lambda f: q_rgb.enqueue(f))
 
 # AE 安定
-for _ in range(30): pipe.wait_for_frames()
+for _ in range(30): q_frames.wait_for_frame()
+
+if RECORD_BAG:
+    # 書き込みは SDK の recorder が担う。ここではキューを空にするだけ
+    print("▶ BAG 録画中 (Ctrl-C で停止):", bag_path)
+    try:
+        while True:
+            try:
+                q_frames.wait_for_frame(2000)
+            except (rs.error, RuntimeError):
+                continue
+    except KeyboardInterrupt:
+        pipe.stop()
+        print("▲ BAG 保存完了:", bag_path)
+        sys.exit(0)
 
 # ---------- ヘルパ ----------
 def mkdir(p): os.makedirs(p, exist_ok=True)
 
+def nvenc_writer(path: str, fps: int, w: int, h: int, is_color: bool,
+                 enc_opts: str = "preset=low-latency-hq"):
+    """GStreamer 経由の NVENC ライタを試す。使えない環境では None を返す。
+
+    エンコードを GPU の専用 ASIC に逃がし、CPU を HDF5 書き込みへ空ける。
+    OpenCV が GStreamer 無しビルドでも nvh264enc 無しでも isOpened() が
+    偽になるだけなので、呼び出し側はソフトウェアエンコードへ落とせる。
+    NVENC の入力は NV12 固定なので、1ch(GRAY8) 入力は caps で明示して
+    videoconvert に変換させる。
+    """
+    if not USE_NVENC or not hasattr(cv, "CAP_GSTREAMER"):
+        return None
+    pre = ("appsrc ! videoconvert ! " if is_color else
+           "appsrc ! videoconvert ! video/x-raw,format=NV12 ! ")
+    pipeline = (pre + f"nvh264enc {enc_opts} "
+                f"! h264parse ! qtmux ! filesink location={path}")
+    try:
+        vw = cv.VideoWriter(pipeline, cv.CAP_GSTREAMER, 0, fps, (w, h), is_color)
+    except cv.error:
+        return None
+    return vw if vw.isOpened() else None
+
 def writer_ir(path: str):
-    """IR を GRAY+MJPG で保存（isColor=False）"""
+    """IR を保存。NVENC が使えれば全イントラ H.264(mp4)、だめなら GRAY+MJPG(avi)。
+
+    gop-size=1 で全フレームをキーフレームにし、MJPG と同じ
+    ランダムアクセス性を保ったままエンコードを ASIC へ逃がす。
+    """
+    vw = nvenc_writer(path.replace(".avi", ".mp4"), IR_FPS, IR_W, IR_H, False,
+                      enc_opts="gop-size=1 preset=low-latency-hq rc-mode=cbr")
+    if vw is not None: return vw
     vw = cv.VideoWriter(path,
                         cv.VideoWriter_fourcc(*"MJPG"),
                         IR_FPS, (IR_W, IR_H), False)
     if not vw.isOpened(): raise IOError(f"open {path}")
     return vw
 
+class CudaRgbWriter:
+    """cv.cudacodec.VideoWriter の薄いラッパ（cv.VideoWriter 互換 API）。
+
+    使い回しの GpuMat へアップロードして NVENC に渡すので、CPU が RGB
+    バイト列に触れるのはアップロードの 1 回だけ（BGR→NV12 変換も GPU 側）。
+    """
+    def __init__(self, path: str):
+        self._writer = cv.cudacodec.createVideoWriter(
+            path, (RGB_W, RGB_H), cv.cudacodec.H264, RGB_FPS,
+            cv.cudacodec.ColorFormat_BGR)
+        self._gpu = cv.cuda_GpuMat()
+
+    def write(self, frame):
+        self._gpu.upload(frame)
+        self._writer.write(self._gpu)
+
+    def release(self):
+        self._writer.release()
+
 def writer_rgb(path: str):
+    """RGB を保存。cudacodec → GStreamer NVENC → mp4v の順で試す。"""
+    if hasattr(cv, "cudacodec"):
+        try:
+            if cv.cuda.getCudaEnabledDeviceCount() > 0:
+                return CudaRgbWriter(path)
+        except Exception:
+            # cv.error 以外（ビルド差による AttributeError 等）でも次の候補へ
+            pass
+    vw = nvenc_writer(path, RGB_FPS, RGB_W, RGB_H, True)
+    if vw is not None: return vw
     vw = cv.VideoWriter(path,
                         cv.VideoWriter_fourcc(*"mp4v"),
                         RGB_FPS, (RGB_W, RGB_H), True)
     if not vw.isOpened(): raise IOError(f"open {path}")
     return vw
 
+def create_depth_dset(f):
+    """depth データセットを低レベル API で作る。
+
+    create_dataset では指定できない dcpl 設定を使うため：
+      • track_times 無効化（オブジェクト更新時刻のメタデータ書き込みを省く）
+      • フィルタ無し時は alloc_time=EARLY で領域を先に確保し、
+        録画中のスペース割り当てによる停止を防ぐ
+    レイアウトはフレーム形状 (H, W) に合わせた 3 次元・1 チャンク = 1
+    フレーム（≈1.5MB）。行単位の書き込みで巨大チャンクの
+    read-modify-write が起きない。bitshuffle+LZ4（hdf5plugin があれば）は
+    ビット面を並べ替えてから圧縮する可逆圧縮で、depth のように上位
+    ビットがほぼ 0 の整数データは 2〜4 倍縮む。
+    """
+    shape = (DEPTH_FPS*BLOCK_SEC, DEPTH_H, DEPTH_W)
+    dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+    dcpl.set_chunk((1, DEPTH_H, DEPTH_W))
+    dcpl.set_obj_track_times(False)
+    if hdf5plugin is not None:
+        comp = dict(hdf5plugin.Bitshuffle(nelems=0, cname="lz4"))
+        dcpl.set_filter(comp["compression"], h5py.h5z.FLAG_OPTIONAL,
+                        tuple(comp["compression_opts"]))
+    else:
+        # 圧縮後サイズが不定なフィルタ有り時は EARLY にしない
+        dcpl.set_alloc_time(h5py.h5d.ALLOC_TIME_EARLY)
+    space = h5py.h5s.create_simple(shape)
+    dt = h5py.h5t.py_create(np.dtype("uint8" if DEPTH_SHIFT else "uint16"))
+    return h5py.Dataset(h5py.h5d.create(f.id, b"depth", dt, space, dcpl))
+
 def open_h5(path: str):
-    cols = DEPTH_W * DEPTH_H
-    f = h5py.File(path, "w")
-    f.attrs.update({"depth_scale": dscale, "width": DEPTH_W, "height": DEPTH_H,
+    # チャンクキャッシュを 64MB に拡大（1 フレーム≈1.5MB × BATCH_FRAMES が乗る）。
+    # w0=0.75 で書き切ったチャンクを優先的に追い出す。
+    # libver="latest" で v2 B-tree のチャンク索引、ページ割り当てで
+    # 細かいメタデータ書き込みを 1MB ページ単位にまとめる
+    f = h5py.File(path, "w", libver="latest",
+                  rdcc_nbytes=64 * 1024 * 1024, rdcc_nslots=100003,
+                  rdcc_w0=0.75,
+                  fs_strategy="page", fs_page_size=1024 * 1024)
+    f.attrs.update({"depth_scale": dscale * (1 << DEPTH_SHIFT),
+                    "depth_shift": DEPTH_SHIFT,
+                    "width": DEPTH_W, "height": DEPTH_H,
                     "depth_fps": DEPTH_FPS, "ir_fps": IR_FPS,
                     "rgb_fps": RGB_FPS, "serial": serial})
-    dset = f.create_dataset("depth", (DEPTH_FPS*BLOCK_SEC, cols),
-                            dtype="uint16", chunks=(64, cols))
-    ts   = f.create_dataset("ts", (DEPTH_FPS*BLOCK_SEC,), dtype="float64")
+    dset = create_depth_dset(f)
+    # タイムスタンプは µs 整数で保存（float64 より少ビットで正確）
+    f.attrs["ts_unit"] = "us"
+    ts   = f.create_dataset("ts", (DEPTH_FPS*BLOCK_SEC,), dtype="int64",
+                            track_times=False)
     return f, dset, ts
 
+# depth/ts はリングバッファへ溜めて BATCH_FRAMES 枚ごとに一括書き込み
+depth_buf = np.empty((BATCH_FRAMES, DEPTH_H, DEPTH_W),
+                     dtype=np.uint8 if DEPTH_SHIFT else np.uint16)
+ts_buf    = np.empty(BATCH_FRAMES, dtype=np.int64)
+
+def aligned_empty(shape, dtype, align=64):
+    """64B 境界に揃えた C 連続バッファを返す。
+
+    np.empty の先頭アドレスは境界保証が無く、libjpeg-turbo（MJPG）や
+    bitshuffle の SIMD パスが非整列入力だと内部コピーに落ちるため、
+    余分に確保してから境界位置のビューを切り出す。
+    """
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    raw = np.empty(nbytes + align, dtype=np.uint8)
+    ofs = (-raw.ctypes.data) % align
+    return raw[ofs:ofs + nbytes].view(dtype).reshape(shape)
+
+# キューへ渡すコピー先もリングで使い回し、毎フレームの malloc を避ける。
+# 段数はキュー容量＋圧縮待ち＋消費中＋書き込み中のぶん（これを超えて同時に生きない）
+RING = WQ_SIZE + 4
+depth_ring = aligned_empty((RING, DEPTH_H, DEPTH_W), np.uint16)
+ir_ring    = aligned_empty((RING, IR_H, IR_W), np.uint8)
+
+# プレビュー用 8bit バッファ（VISUALIZE 時のみ使用）
+depth8_vis = np.empty((DEPTH_H, DEPTH_W), dtype=np.uint8)
+
+if njit is not None:
+    @njit(nogil=True, cache=True)
+    def stage(src, dst):
+        """リングのスロットへコピー。nogil なのでコピー中も
+        書き込みワーカ（HDF5/エンコーダの C 拡張）が並走できる。"""
+        for i in range(src.shape[0]):
+            for j in range(src.shape[1]):
+                dst[i, j] = src[i, j]
+else:
+    def stage(src, dst):
+        np.copyto(dst, src)
+
+# ---- 書き込みワーカ（HDF5/エンコードの詰まりでキャプチャを止めないため分離） ----
+def flush_depth(dset, ts, n, idx, direct):
+    """バッファ済み depth フレームを idx の手前 n 行へまとめて書く。"""
+    i0 = idx - n
+    if direct:
+        # フィルタ無しなら h5py の選択機構を介さずチャンクへ直接書き込む
+        # （1 チャンク = 1 フレームなのでオフセットは行番号そのまま）
+        for k in range(n):
+            dset.id.write_direct_chunk((i0 + k, 0, 0), depth_buf[k].tobytes())
+    else:
+        dset[i0:idx] = depth_buf[:n]
+    ts[i0:idx] = ts_buf[:n]
+
+BSHUF_ID    = 32008   # HDF5 bitshuffle フィルタの ID
+BSHUF_BLOCK = 2048    # ブロック長（要素数）。格納形式のヘッダに記録する
+
+def bshuf_pack(frame):
+    """bitshuffle+LZ4 で圧縮し、HDF5 フィルタの格納形式に詰める。
+
+    格納形式 = 8B 元サイズ(BE) + 4B ブロックバイト数(BE) + LZ4 ブロック列。
+    これを filter_mask=0 で write_direct_chunk すれば、HDF5 側の
+    フィルタパイプラインを通さずに済む（読み出しは通常どおり）。
+    """
+    comp = bitshuffle.compress_lz4(frame, BSHUF_BLOCK)
+    return struct.pack(">QI", frame.nbytes,
+                       BSHUF_BLOCK * frame.itemsize) + comp.tobytes()
+
+# ワーカ例外の通知。ディスクフル等でワーカが死ぬとキューが満杯のまま残り、
+# 終了処理の put(None)/join が永久に固まるため、キャプチャループが監視する
+worker_failed = threading.Event()
+
+def depth_worker(q: queue.Queue, dset, ts):
+    """depth フレームを BATCH_FRAMES 枚ずつ HDF5 へ書くワーカ。None で終了。
+
+    bitshuffle モジュールがあれば圧縮を 2 本のスレッドプールで先行実行し、
+    圧縮済みバイト列を write_direct_chunk で直接格納する（LZ4/bitshuffle の
+    C 実装は GIL を解放するので実並列になる）。
+    """
+    try:
+        # .compression は外部プラグインのフィルタを認識しないため plist で判定
+        dcpl   = dset.id.get_create_plist()
+        direct = dcpl.get_nfilters() == 0
+        bshuf  = (bitshuffle is not None and not DEPTH_SHIFT
+                  and dcpl.get_nfilters() == 1
+                  and dcpl.get_filter(0)[0] == BSHUF_ID)
+        pool    = ThreadPoolExecutor(max_workers=2) if bshuf else None
+        pending = deque()   # (行番号, 圧縮済みバイト列の future)
+
+        def drain(limit):
+            # 完了済みを書き、limit 本を超えるぶんは完了を待って書く
+            while len(pending) > limit or (pending and pending[0][1].done()):
+                i, fut = pending.popleft()
+                dset.id.write_direct_chunk((i, 0, 0), fut.result(), filter_mask=0)
+
+        idx = n = 0
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            if bshuf:
+                pending.append((idx, pool.submit(bshuf_pack, item[0])))
+                ts_buf[n] = int(item[1] * 1000)  # ms(float) → µs(int)
+                n += 1; idx += 1
+                drain(2)   # リングのスロット寿命を抑えるため溜め込まない
+                if n == BATCH_FRAMES:
+                    ts[idx-n:idx] = ts_buf[:n]
+                    n = 0
+                continue
+            if DEPTH_SHIFT:  # 量子化（255 で飽和させてから uint8 へ）
+                depth_buf[n] = np.minimum(item[0] >> DEPTH_SHIFT, 255)
+            else:
+                depth_buf[n] = item[0]
+            ts_buf[n] = int(item[1] * 1000)  # ms(float) → µs(int)
+            n += 1; idx += 1
+            if n == BATCH_FRAMES:
+                flush_depth(dset, ts, n, idx, direct)
+                n = 0
+        if bshuf:
+            drain(0)
+            pool.shutdown()
+            if n:
+                ts[idx-n:idx] = ts_buf[:n]
+        elif n:   # 端数バッファを書き切る
+            flush_depth(dset, ts, n, idx, direct)
+    except Exception as e:
+        print(f"depth_worker 異常終了: {e}", file=sys.stderr)
+        worker_failed.set()
+
+def video_worker(q: queue.Queue, vw):
+    """フレームを VideoWriter へ流すワーカ（IR/RGB 共用）。None で終了。"""
+    try:
+        while True:
+            img = q.get()
+            if img is None:
+                break
+            vw.write(img)
+    except Exception as e:
+        print(f"video_worker 異常終了: {e}", file=sys.stderr)
+        worker_failed.set()
+
+def put_blocking(q: queue.Queue, item):
+    """無欠損用のブロッキング put。ワーカ死亡を検知したら例外で録画を止める。"""
+    while True:
+        if worker_failed.is_set():
+            raise RuntimeError("書き込みワーカが停止しました（ディスク異常の可能性）")
+        try:
+            q.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
+
+def stop_workers(queues, threads):
+    """ワーカへ終了を通知して回収する。死んだワーカがいても固まらない。"""
+    for q in queues:
+        try:
+            q.put(None, timeout=2)
+        except queue.Full:
+            pass   # ワーカ死亡でキューが満杯のまま。daemon なので放置してよい
+    for t in threads:
+        t.join(timeout=10)
+
+def preview_worker(q: queue.Queue, stop_evt: threading.Event):
+    """プレビュー描画スレッド。変換・imshow・waitKey のコストをここへ寄せ、
+    キャプチャスレッドは put_nowait だけで済ます。'q' で stop_evt を立てる。"""
+    while True:
+        item = q.get()
+        if item is None:
+            break
+        depth_img, ir_img, rgb_img = item
+        cv.convertScaleAbs(depth_img, dst=depth8_vis, alpha=0.03)
+        cv.imshow("Depth", depth8_vis)
+        cv.imshow("IR", ir_img)
+        if rgb_img is not None:
+            cv.imshow("RGB", rgb_img)
+        if cv.waitKey(1) & 0xFF == ord('q'):
+            stop_evt.set()
+    cv.destroyAllWindows()
+
+preview_q    = queue.Queue(maxsize=1)   # 最新 1 枚だけ。描画が遅れたら捨てる
+preview_stop = threading.Event()
+if VISUALIZE:
+    threading.Thread(target=preview_worker,
+                     args=(preview_q, preview_stop), daemon=True).start()
+
 # ---------- 録画ループ ----------
+made_hour = None   # 同じ時間帯なら mkdir を省く
 while True:
     now = time.localtime()
     date_str, hour_str = time.strftime("%Y%m%d", now), time.strftime("%H", now)
@@ -95,7 +428,9 @@ while True:
     ddir = os.path.join(base, "Depth", hour_str)
     idir = os.path.join(base, "IR",    hour_str)
     rdir = os.path.join(base, "RGB",   hour_str)
-    for p in (ddir, idir, rdir): mkdir(p)
+    if made_hour != (date_str, hour_str):
+        for p in (ddir, idir, rdir): mkdir(p)
+        made_hour = (date_str, hour_str)
 
     prefix  = f"{date_str}_{hour_str}{now.tm_min:02d}{now.tm_sec:02d}"
     h5_path = os.path.join(ddir, f"{prefix}.h5")
@@ -119,37 +454,61 @@ while True:
 
     depth_idx = ir_count = rgb_count = 0
     print("▶ 新ブロック:", prefix)
+
+    # ブロック単位のワーカスレッド（キューが満杯なら put がブロックし無欠損）
+    depth_q = queue.Queue(maxsize=WQ_SIZE)
+    ir_q    = queue.Queue(maxsize=WQ_SIZE)
+    rgb_q   = queue.Queue(maxsize=WQ_SIZE)
+    workers = [
+        threading.Thread(target=depth_worker, args=(depth_q, dset, ts), daemon=True),
+        threading.Thread(target=video_worker, args=(ir_q,  ir_w),  daemon=True),
+        threading.Thread(target=video_worker, args=(rgb_q, rgb_w), daemon=True),
+    ]
+    for t in workers: t.start()
     try:
         while depth_idx < DEPTH_FPS * BLOCK_SEC:
             try:
-                fs = pipe.wait_for_frames(timeout_ms=2000)
-            except rs.error: continue
+                fs = q_frames.wait_for_frame(2000).as_frameset()
+            except (rs.error, RuntimeError): continue
             dfrm, ifrm = fs.get_depth_frame(), fs.get_infrared_frame()
             if not (dfrm and ifrm): continue
 
-            # Depth → HDF5
-            depth = np.asanyarray(dfrm.get_data(), dtype=np.uint16)
-            dset[depth_idx] = depth.reshape(-1)
-            ts[depth_idx]   = dfrm.get_timestamp()
+            # Depth → ワーカへ（frombuffer はコピー無しのビュー。
+            # リングのスロットへ copy して RealSense 側バッファから切り離す）
+            depth = np.frombuffer(dfrm.get_data(),
+                                  dtype=np.uint16).reshape(DEPTH_H, DEPTH_W)
+            slot = depth_ring[depth_idx % RING]
+            stage(depth, slot)
+            put_blocking(depth_q, (slot, dfrm.get_timestamp()))
             depth_idx += 1
 
-            # IR → MJPG (GRAY)
-            ir_img = np.asanyarray(ifrm.get_data())  # uint8 (H,W)
-            ir_w.write(ir_img); ir_count += 1
+            # IR → ワーカへ（frombuffer はコピー無しのビュー）
+            ir_img = np.frombuffer(ifrm.get_data(),
+                                   dtype=np.uint8).reshape(IR_H, IR_W)
+            ir_slot = ir_ring[ir_count % RING]
+            stage(ir_img, ir_slot)
+            put_blocking(ir_q, ir_slot); ir_count += 1
 
-            # RGB → mp4
+            # RGB → ワーカへ
+            rgb_img = None
             rgb_frame = q_rgb.poll_for_frame()
             if rgb_frame and rgb_count < RGB_FPS*BLOCK_SEC:
-                rgb_w.write(np.asanyarray(rgb_frame.get_data())); rgb_count += 1
+                rgb_view = np.frombuffer(rgb_frame.get_data(),
+                                         dtype=np.uint8).reshape(RGB_H, RGB_W, 3)
+                rgb_img = rgb_view.copy()
+                put_blocking(rgb_q, rgb_img)
+                rgb_count += 1
 
-            # プレビュー（任意）
+            # プレビュー（任意。キャプチャ側は put_nowait のみで描画は別スレッド）
             if VISUALIZE and depth_idx % 30 == 0:
-                cv.imshow("Depth", cv.convertScaleAbs(depth, alpha=0.03))
-                cv.imshow("IR", ir_img)
-                if rgb_count: cv.imshow("RGB", np.asanyarray(rgb_frame.get_data()))
-                if cv.waitKey(1) & 0xFF == ord('q'):
+                if preview_stop.is_set():   # プレビュー側で 'q'
                     raise KeyboardInterrupt
+                try:
+                    preview_q.put_nowait((slot, ir_slot, rgb_img))
+                except queue.Full:
+                    pass
     finally:
+        stop_workers((depth_q, ir_q, rgb_q), workers)
         h5f.close(); ir_w.release(); rgb_w.release()
         print(f"▲ 保存完了: Depth={depth_idx}  IR={ir_count}  RGB={rgb_count}")
 
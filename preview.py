@@ -44,6 +44,18 @@ for _ in range(30):
 
 print("=== PREVIEW START (press 'q' to quit) ===")
 
+# 変換の出力先は使い回す（毎フレームの確保を避ける）
+depth_8u = np.empty((DEPTH_H, DEPTH_W), dtype=np.uint8)
+
+# CUDA 対応ビルドなら 16→8bit 変換を GPU に逃がす（GpuMat も使い回し）
+try:
+    use_cuda = cv.cuda.getCudaEnabledDeviceCount() > 0
+except (AttributeError, cv.error):
+    use_cuda = False
+if use_cuda:
+    d_depth  = cv.cuda_GpuMat(DEPTH_H, DEPTH_W, cv.CV_16U)
+    d_depth8 = cv.cuda_GpuMat(DEPTH_H, DEPTH_W, cv.CV_8U)
+
 try:
     while True:
         frames = pipe.wait_for_frames(timeout_ms=2000)
@@ -54,20 +66,28 @@ try:
             continue
 
         # Depth: 16-bit → 8-bit グレースケール (線形)
-        depth = np.asanyarray(dfrm.get_data(), dtype=np.uint16)
-        depth_8u = (depth >> 8).astype(np.uint8)
-        depth_vis = cv.cvtColor(depth_8u, cv.COLOR_GRAY2BGR)
+        # frombuffer はコピー無しのビュー。convertScaleAbs は
+        # シフト+キャストを 1 パス(SIMD)で行う
+        depth = np.frombuffer(dfrm.get_data(),
+                              dtype=np.uint16).reshape(DEPTH_H, DEPTH_W)
+        if use_cuda:
+            d_depth.upload(depth)
+            d_depth.convertTo(cv.CV_8U, 1 / 256.0, d_depth8)
+            d_depth8.download(depth_8u)
+        else:
+            cv.convertScaleAbs(depth, dst=depth_8u, alpha=1 / 256.0)
 
-        # IR (1ch) → 3ch 揃え
-        ir_img = np.asanyarray(ifrm.get_data())  # uint8
-        ir_vis = cv.cvtColor(ir_img, cv.COLOR_GRAY2BGR)
+        # IR (1ch のまま表示。imshow は GRAY を直接受け付ける)
+        ir_img = np.frombuffer(ifrm.get_data(),
+                               dtype=np.uint8).reshape(IR_H, IR_W)
 
         # RGB (すでに BGR 順)
-        rgb_vis = np.asanyarray(cfrm.get_data())  # (H,W,3) uint8
+        rgb_vis = np.frombuffer(cfrm.get_data(),
+                                dtype=np.uint8).reshape(RGB_H, RGB_W, 3)
 
         # ウィンドウ表示（録画と同サイズそのまま）
-        cv.imshow("Depth (RAW-GRAY)", depth_vis)
-        cv.imshow("IR",              ir_vis)
+        cv.imshow("Depth (RAW-GRAY)", depth_8u)
+        cv.imshow("IR",              ir_img)
         cv.imshow("RGB",             rgb_vis)
 
         if cv.waitKey(1) & 0xFF == ord('q'):
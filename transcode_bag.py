@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+rosbag (.bag) → HDF5 + AVI 変換スクリプト
+
+lossless_RGB_IR_depth.py の RECORD_BAG=True で録った .bag を、
+録画時と同じレイアウト（depth: (T,H,W) uint16 + ts µs、IR: GRAY+MJPG、
+RGB: BGR+mp4v）へオフラインで変換する。リアルタイム制約が無いので、
+圧縮・エンコードは CPU の空き時間でまとめて行える。
+
+使い方: python transcode_bag.py <file.bag> [<file2.bag> ...]
+出力  : <file>.h5 / <file>.avi / <file>.mp4（.bag と同じ場所）
+"""
+
+from __future__ import annotations
+import os, sys
+import numpy as np, cv2 as cv, h5py, pyrealsense2 as rs
+
+try:
+    import hdf5plugin  # 任意依存（あれば depth を bitshuffle+LZ4 で可逆圧縮）
+except ImportError:
+    hdf5plugin = None
+
+# -------- ユーザ設定（録画スクリプトと同じ値に合わせる） --------
+DEPTH_W, DEPTH_H  = 1024, 768
+IR_W,    IR_H     = 1024, 768
+IR_FPS            = 30
+RGB_W,   RGB_H    = 1280, 720
+RGB_FPS           = 6
+BATCH_FRAMES      = 30               # depth/ts をこの枚数ずつまとめて書く
+# ----------------------------------------------------------------
+
+RsErr = rs.error if hasattr(rs, "error") else Exception
+
+
+def transcode(bag_path: str):
+    cfg = rs.config()
+    cfg.enable_device_from_file(bag_path, repeat_playback=False)
+    pipe = rs.pipeline()
+    prof = pipe.start(cfg)
+    dev  = prof.get_device()
+    dev.as_playback().set_real_time(False)  # 取りこぼし無しで最速再生
+    dscale = dev.first_depth_sensor().get_depth_scale()
+
+    base     = os.path.splitext(bag_path)[0]
+    h5_path  = base + ".h5"
+    avi_path = base + ".avi"
+    mp4_path = base + ".mp4"
+
+    comp = (dict(hdf5plugin.Bitshuffle(nelems=0, cname="lz4"))
+            if hdf5plugin is not None else {})
+    f = h5py.File(h5_path, "w", libver="latest",
+                  rdcc_nbytes=64 * 1024 * 1024, rdcc_nslots=100003)
+    f.attrs.update({"depth_scale": dscale, "width": DEPTH_W, "height": DEPTH_H,
+                    "ts_unit": "us",
+                    "source_bag": os.path.basename(bag_path)})
+    # フレーム数は再生してみないと分からないので可変長 + 1 チャンク = 1 フレーム
+    dset = f.create_dataset("depth", (0, DEPTH_H, DEPTH_W),
+                            maxshape=(None, DEPTH_H, DEPTH_W),
+                            dtype="uint16", chunks=(1, DEPTH_H, DEPTH_W), **comp)
+    ts   = f.create_dataset("ts", (0,), maxshape=(None,), dtype="int64")
+    vw = cv.VideoWriter(avi_path, cv.VideoWriter_fourcc(*"MJPG"),
+                        IR_FPS, (IR_W, IR_H), False)
+    if not vw.isOpened():
+        raise IOError(f"open {avi_path}")
+
+    # RGB は色ストリームを含まない古い bag もあるため、
+    # 最初のカラーフレームが来た時点で初めてライタを開く
+    rgb_vw = None
+
+    dbuf = np.empty((BATCH_FRAMES, DEPTH_H, DEPTH_W), dtype=np.uint16)
+    tbuf = np.empty(BATCH_FRAMES, dtype=np.int64)
+    rows = n = ir_count = rgb_count = 0
+    print("▶ 変換開始:", bag_path)
+
+    def flush():
+        nonlocal rows, n
+        rows += n
+        dset.resize(rows, 0); ts.resize(rows, 0)
+        dset[rows-n:rows] = dbuf[:n]
+        ts[rows-n:rows]   = tbuf[:n]
+        n = 0
+
+    try:
+        while True:
+            try:
+                fs = pipe.wait_for_frames(timeout_ms=1000)
+            except (RsErr, RuntimeError):
+                break  # 再生終了
+            dfrm, ifrm = fs.get_depth_frame(), fs.get_infrared_frame()
+            cfrm = fs.get_color_frame()
+            if dfrm:
+                dbuf[n] = np.frombuffer(dfrm.get_data(),
+                                        dtype=np.uint16).reshape(DEPTH_H, DEPTH_W)
+                tbuf[n] = int(dfrm.get_timestamp() * 1000)  # ms(float) → µs(int)
+                n += 1
+                if n == BATCH_FRAMES:
+                    flush()
+            if ifrm:
+                vw.write(np.frombuffer(ifrm.get_data(),
+                                       dtype=np.uint8).reshape(IR_H, IR_W))
+                ir_count += 1
+            if cfrm:
+                if rgb_vw is None:
+                    rgb_vw = cv.VideoWriter(mp4_path,
+                                            cv.VideoWriter_fourcc(*"mp4v"),
+                                            RGB_FPS, (RGB_W, RGB_H), True)
+                    if not rgb_vw.isOpened():
+                        raise IOError(f"open {mp4_path}")
+                rgb_vw.write(np.frombuffer(cfrm.get_data(),
+                                           dtype=np.uint8).reshape(RGB_H, RGB_W, 3))
+                rgb_count += 1
+    finally:
+        if n:
+            flush()
+        pipe.stop(); f.close(); vw.release()
+        if rgb_vw is not None:
+            rgb_vw.release()
+    print(f"▲ 変換完了: Depth={rows}  IR={ir_count}  RGB={rgb_count}  → {h5_path}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("usage: python transcode_bag.py <file.bag> ...")
+    for p in sys.argv[1:]:
+        transcode(p)